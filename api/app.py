@@ -2,25 +2,58 @@
 # Main Flask application file.
 
 import os
+import atexit
 import datetime
 import sqlite3 # Import for specific exception handling
 from functools import wraps # For the decorator
 from flask import Flask, request, jsonify, g # Import g for context-local storage
 from werkzeug.security import check_password_hash, generate_password_hash
 import jwt # Requires PyJWT library: pip install PyJWT
+import threading
 from collections import deque, defaultdict # Import deque and defaultdict for queues
 
 # Import database functions from database.py
 import database
+# Binary payload decoders for sensor/wearable clients
+import ingest
+# Vectorized threshold/anomaly checks over monitor samples
+import evaluation
+# Periodic snapshots of in-memory state for warm restarts
+import state_snapshot
+# orjson/MessagePack serialization and gzip for responses
+import json_provider
+# Opt-in flamegraph profiles of individual requests
+import request_profiler
 
 # --- Configuration ---
 SECRET_KEY = 'your-very-secret-and-secure-key' # CHANGE THIS!
 TOKEN_EXPIRATION_MINUTES = 60
 ALLOWED_USER_TYPES = ('guardian', 'protege', None) # Define allowed types including None
+DEBUG = True # Use False in production!
+SENSOR_EVALUATION_INTERVAL_SECONDS = 10
+SENSOR_THRESHOLDS = evaluation.DEFAULT_THRESHOLDS
+USE_USER_SNAPSHOT = True # Serve user lookups from memory (see database.UserSnapshot)
+STATE_SNAPSHOT_PATH = 'server_state.snapshot' # Set to None to disable state snapshots
+STATE_SNAPSHOT_INTERVAL_SECONDS = 5
+GZIP_MIN_RESPONSE_BYTES = 1024 # Compress larger responses; None disables gzip
+PROFILE_ALL_REQUESTS = False # Profile every request (still rate-limited)
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN') # Profile requests sending this X-Profile-Token
+PROFILE_DIR = 'profiles'
+PROFILE_MIN_INTERVAL_SECONDS = 1.0
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
+json_provider.init_app(app, gzip_min_size=GZIP_MIN_RESPONSE_BYTES)
+request_profiler.init_app(
+    app, PROFILE_DIR,
+    admin_token=PROFILE_ADMIN_TOKEN,
+    profile_all=PROFILE_ALL_REQUESTS,
+    min_interval=PROFILE_MIN_INTERVAL_SECONDS
+)
+
+if USE_USER_SNAPSHOT:
+    database.enable_user_snapshot()
 
 # --- Authentication Decorator ---
 
@@ -46,8 +79,8 @@ def token_required(f):
             user_id = payload['sub'] # Get user ID from 'sub' claim
             # Fetch the current user from DB and store it in Flask's g object
             # g is context-local and available throughout the request
-            # query_db now returns a dictionary or None
-            current_user = database.query_db('SELECT * FROM users WHERE id = ?', [user_id], one=True)
+            # get_user_by_id returns a dictionary or None (served from the snapshot when enabled)
+            current_user = database.get_user_by_id(user_id)
             if not current_user:
                  return jsonify({"error": "User associated with token not found"}), 401
             g.current_user = current_user # Store user dict in g
@@ -85,6 +118,16 @@ def generate_auth_token(user_id):
         print(f"Error generating token: {e}")
         return None
 
+def user_to_response(user):
+    """Builds the public user representation returned by the API."""
+    return {
+        "userId": str(user['id']),
+        "name": user['name'],
+        "email": user['email'],
+        "user_type": user['user_type'],
+        "friend_email": user['friend_email']
+    }
+
 # --- API Endpoints ---
 
 @app.route('/api/auth/login', methods=['POST'])
@@ -100,8 +143,8 @@ def login():
     if not email or not password:
         return jsonify({"error": "Missing email or password"}), 400
 
-    # query_db returns a dictionary or None
-    user_row = database.query_db('SELECT * FROM users WHERE email = ?', [email], one=True)
+    # get_user_by_email returns a dictionary or None
+    user_row = database.get_user_by_email(email)
 
     # Check if user_row is not None and password matches
     if user_row and check_password_hash(user_row['password_hash'], password):
@@ -110,14 +153,8 @@ def login():
              return jsonify({"error": "Could not generate authentication token"}), 500
 
         # Prepare user info from the dictionary
-        user_info = {
-            "userId": str(user_row['id']),
-            "email": user_row['email'],
-            "name": user_row['name'],
-            "user_type": user_row['user_type'],     # Added
-            "friend_email": user_row['friend_email'], # Added (can be null)
-            "authToken": token
-        }
+        user_info = user_to_response(user_row)
+        user_info["authToken"] = token
         return jsonify(user_info), 200
     else:
         # Handles both user not found and incorrect password
@@ -154,21 +191,9 @@ def update_profile():
 
         if success:
             # Fetch updated user data to return
-            updated_user = database.query_db(
-                'SELECT id, name, email, user_type, friend_email FROM users WHERE id = ?',
-                [current_user['id']],
-                one=True
-            )
+            updated_user = database.get_user_by_id(current_user['id'])
             if updated_user:
-                # Prepare response format
-                response_user = {
-                    "userId": str(updated_user['id']),
-                    "name": updated_user['name'],
-                    "email": updated_user['email'],
-                    "user_type": updated_user['user_type'],
-                    "friend_email": updated_user['friend_email']
-                }
-                return jsonify({"message": "Profile updated successfully", "user": response_user}), 200
+                return jsonify({"message": "Profile updated successfully", "user": user_to_response(updated_user)}), 200
             else:
                 # Should not happen if update succeeded, but handle defensively
                 return jsonify({"error": "Failed to retrieve updated profile"}), 500
@@ -236,11 +261,26 @@ def send_alert():
         "type": alert_type
     }), 200
 
-ALLOWED_NOTIFICATION_TYPES = ('check_ok', 'yes_ok', 'no_ok', 'fall_detected', 'bpm_low', 'bpm_high', 'not_well') # Define allowed notification types
+# Define allowed notification types (client-sendable; evaluation.NOTIFICATION_TYPES are server-only)
+# Order matters: binary clients send the index into this tuple, so only append new types.
+ALLOWED_NOTIFICATION_TYPES = ('check_ok', 'yes_ok', 'no_ok', 'fall_detected', 'bpm_low', 'bpm_high', 'not_well')
 
 notification_queues = defaultdict(lambda: {'queue': deque(), 'present': set()})
+# Queues are also filled by the sensor evaluation thread, not only by requests
+notification_lock = threading.Lock()
 
 
+def enqueue_notification(recipient_email, sender_email, notification_type):
+    """Adds a notification to the recipient's queue. Returns False if it was already queued."""
+    notification_tuple = (sender_email, notification_type)
+    with notification_lock:
+        queue_data = notification_queues[recipient_email]
+        if notification_tuple in queue_data['present']:
+            return False
+        queue_data['present'].add(notification_tuple)
+        queue_data['queue'].append({"sender_email": sender_email, "type": notification_type})
+        return True
+
 
 @app.route('/api/notify/send', methods=['POST'])
 def send_notification():
@@ -248,9 +288,15 @@ def send_notification():
     Receives notification data and adds it to the recipient's in-memory queue.
     Does not require authentication.
     Expects JSON: {"recipient_email": "...", "sender_email": "...", "notification_type": "..."}
+    or a binary payload sent as ingest.NOTIFICATION_CONTENT_TYPE (see ingest.py).
     """
-    if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
-    data = request.get_json()
+    if request.mimetype == ingest.NOTIFICATION_CONTENT_TYPE:
+        try:
+            data = ingest.decode_notification_payload(request.get_data(cache=False), ALLOWED_NOTIFICATION_TYPES)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    elif not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
+    else: data = request.get_json()
     recipient_email = data.get('recipient_email')
     sender_email = data.get('sender_email')
     notification_type = data.get('notification_type')
@@ -261,12 +307,7 @@ def send_notification():
         return jsonify({"error": f"Invalid 'notification_type'. Allowed: {ALLOWED_NOTIFICATION_TYPES}"}), 400
 
     # Add to queue, avoiding duplicates
-    queue_data = notification_queues[recipient_email]
-    notification_tuple = (sender_email, notification_type)
-
-    if notification_tuple not in queue_data['present']:
-        queue_data['present'].add(notification_tuple)
-        queue_data['queue'].append({"sender_email": sender_email, "type": notification_type})
+    if enqueue_notification(recipient_email, sender_email, notification_type):
         print(f"Notification added to queue for {recipient_email}: From={sender_email}, Type={notification_type}")
         message = "Notification added to queue."
     else:
@@ -286,13 +327,16 @@ def check_notification_inbox():
     """
     recipient_email = g.current_user['email']
 
-    if recipient_email in notification_queues and notification_queues[recipient_email]['queue']:
-        # Queue exists and is not empty
-        queue_data = notification_queues[recipient_email]
-        notification = queue_data['queue'].popleft() # Get and remove the oldest notification
-        notification_tuple = (notification['sender_email'], notification['type'])
-        queue_data['present'].remove(notification_tuple) # Remove from the presence set
+    notification = None
+    with notification_lock:
+        if recipient_email in notification_queues and notification_queues[recipient_email]['queue']:
+            # Queue exists and is not empty
+            queue_data = notification_queues[recipient_email]
+            notification = queue_data['queue'].popleft() # Get and remove the oldest notification
+            notification_tuple = (notification['sender_email'], notification['type'])
+            queue_data['present'].remove(notification_tuple) # Remove from the presence set
 
+    if notification:
         print(f"Notification retrieved for {recipient_email}: {notification}")
         return jsonify(notification), 200
     else:
@@ -331,14 +375,9 @@ def change_user_type():
         )
         if success:
             # Fetch updated user data to return
-            updated_user = database.query_db('SELECT id, name, email, user_type, friend_email FROM users WHERE id = ?', [current_user['id']], one=True)
+            updated_user = database.get_user_by_id(current_user['id'])
             if updated_user:
-                 response_user = {
-                    "userId": str(updated_user['id']), "name": updated_user['name'],
-                    "email": updated_user['email'], "user_type": updated_user['user_type'],
-                    "friend_email": updated_user['friend_email']
-                 }
-                 return jsonify({"message": f"User type successfully changed to '{new_type if new_type is not None else 'None'}'", "user": response_user}), 200
+                 return jsonify({"message": f"User type successfully changed to '{new_type if new_type is not None else 'None'}'", "user": user_to_response(updated_user)}), 200
             else:
                  # This really shouldn't happen if the update was successful
                  return jsonify({"error": "Failed to retrieve updated profile after type change."}), 500
@@ -380,7 +419,7 @@ def request_guardian():
          return jsonify({"error": "Cannot link to yourself."}), 400
 
     # Find and validate the guardian
-    guardian_user = database.query_db('SELECT * FROM users WHERE email = ?', [guardian_email], one=True)
+    guardian_user = database.get_user_by_email(guardian_email)
     if not guardian_user:
         return jsonify({"error": f"Guardian with email '{guardian_email}' not found."}), 404 # Not Found
     if guardian_user['user_type'] != 'guardian':
@@ -439,6 +478,8 @@ latest_monitor_data = {
     "humidity": None,
     "timestamp": None # Optional: Store when data was last received
 }
+# Recent samples per protege, checked server-side on every evaluation tick
+sensor_windows = evaluation.SensorWindows()
 
 @app.route('/api/guardians/available', methods=['GET']) # New endpoint for available guardians
 @token_required # Optional: Decide if this needs authentication
@@ -471,13 +512,23 @@ def monitor_up():
 
 @app.route('/api/monitor/data', methods=['PUT'])
 def monitor_data():
-    """Receives monitoring data (temperature, humidity) and stores it in memory."""
+    """
+    Receives monitoring data (temperature, humidity) and stores it in memory.
+    Accepts JSON or the compact binary sample sent as ingest.MONITOR_CONTENT_TYPE.
+    An optional 'protege_email' attributes the sample to a protege so it is
+    checked by the server-side evaluation and alerts reach their guardian.
+    """
     global latest_monitor_data # Declare intent to modify the global variable
 
-    if not request.is_json:
+    if request.mimetype == ingest.MONITOR_CONTENT_TYPE:
+        try:
+            data = ingest.decode_monitor_payload(request.get_data(cache=False))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    elif not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 400
-
-    data = request.get_json()
+    else:
+        data = request.get_json()
     temperature = data.get('temperature')
     humidity = data.get('humidity')
 
@@ -486,6 +537,9 @@ def monitor_data():
         return jsonify({"error": "Missing 'temperature' key"}), 400
     if 'humidity' not in data:
         return jsonify({"error": "Missing 'humidity' key"}), 400
+    protege_email = data.get('protege_email')
+    if protege_email is not None and not isinstance(protege_email, str):
+        return jsonify({"error": "'protege_email' must be a string"}), 400
 
     # --- Store Data In Memory ---
     # Update the global dictionary with the new values
@@ -494,6 +548,14 @@ def monitor_data():
     latest_monitor_data['timestamp'] = datetime.datetime.utcnow().isoformat() + 'Z' # Store timestamp in ISO format UTC
 
     print(f"Received and stored monitoring data: Temperature={temperature}, Humidity={humidity} at {latest_monitor_data['timestamp']}")
+
+    # Only known proteges get a sensor window, so arbitrary emails cannot grow the buffers
+    if protege_email:
+        protege = database.get_user_by_email(protege_email)
+        if protege and protege['user_type'] == 'protege':
+            sensor_windows.record(protege_email, data)
+        else:
+            print(f"Monitoring data not evaluated: '{protege_email}' is not a registered protege.")
     # --- End Store Data ---
 
     return jsonify({"message": "Monitoring data received and stored successfully."}), 200
@@ -505,6 +567,51 @@ def get_current_monitor_data():
     # The dictionary contains 'temperature', 'humidity', and 'timestamp'
     return jsonify(latest_monitor_data), 200
 
+def run_sensor_evaluation():
+    """Evaluates all fresh monitor samples and notifies the linked guardians of any alerts."""
+    alerts = sensor_windows.evaluate(SENSOR_THRESHOLDS)
+    if not alerts:
+        return
+
+    guardians = database.get_friend_emails({protege_email for protege_email, _ in alerts})
+    queued = 0
+    for protege_email, notification_type in alerts:
+        guardian_email = guardians.get(protege_email)
+        if guardian_email and enqueue_notification(guardian_email, protege_email, notification_type):
+            queued += 1
+    print(f"Sensor evaluation: {len(alerts)} alerts, {queued} notifications queued.")
+
+# --- In-Memory State Snapshots ---
+
+def capture_state():
+    """Copies the in-memory state into plain structures. Locks are held only while copying."""
+    with notification_lock:
+        queues = {email: list(queue_data['queue']) for email, queue_data in notification_queues.items() if queue_data['queue']}
+    return {
+        "notification_queues": queues,
+        "latest_monitor_data": dict(latest_monitor_data),
+        "sensor_windows": sensor_windows.export_state(),
+    }
+
+def restore_state(state):
+    """Loads state captured by capture_state() back into memory."""
+    with notification_lock:
+        notification_queues.clear()
+        for email, notifications in state["notification_queues"].items():
+            queue_data = notification_queues[email]
+            queue_data['queue'].extend(notifications)
+            queue_data['present'].update((n['sender_email'], n['type']) for n in notifications)
+    latest_monitor_data.update(state["latest_monitor_data"])
+    try:
+        sensor_windows.restore_state(state["sensor_windows"])
+    except ValueError as e:
+        print(f"Sensor windows not restored: {e}")
+    print(f"Restored state: {len(state['notification_queues'])} notification queues, monitor data from {latest_monitor_data['timestamp']}.")
+
+def save_state_snapshot():
+    """Writes the current in-memory state to STATE_SNAPSHOT_PATH."""
+    state_snapshot.save_snapshot(STATE_SNAPSHOT_PATH, capture_state())
+
 @app.route('/')
 def index():
     """A simple index route to check if the server is running."""
@@ -512,6 +619,27 @@ def index():
 
 # --- Main Execution ---
 
+def start_ticker(interval_seconds, tick):
+    """Calls tick() every interval_seconds on a daemon thread. Returns an Event that stops it."""
+    stop_event = threading.Event()
+
+    def run():
+        while not stop_event.wait(interval_seconds):
+            try:
+                tick()
+            except Exception as e:
+                print(f"Error during periodic task {getattr(tick, '__name__', tick)}: {e}")
+
+    threading.Thread(target=run, name=f"ticker-{getattr(tick, '__name__', 'task')}", daemon=True).start()
+    return stop_event
+
+def start_background_tasks():
+    """Starts the periodic server-side tasks."""
+    start_ticker(SENSOR_EVALUATION_INTERVAL_SECONDS, run_sensor_evaluation)
+    if STATE_SNAPSHOT_PATH:
+        start_ticker(STATE_SNAPSHOT_INTERVAL_SECONDS, save_state_snapshot)
+        atexit.register(save_state_snapshot) # Final snapshot on clean shutdown
+
 if __name__ == '__main__':
     db_path = database.DATABASE
     # Create and initialize DB only if it doesn't exist
@@ -525,6 +653,14 @@ if __name__ == '__main__':
         # For this example, if schema changes, delete the .db file and restart.
 
     print(f"Starting Flask server on http://0.0.0.0:5000 (SECRET_KEY: {'Set' if SECRET_KEY != 'your-very-secret-and-secure-key' else '!!!Using Default - CHANGE IT!!!'})")
+    # With the debug reloader, only restore state and start background tasks in the serving child process
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if STATE_SNAPSHOT_PATH:
+            saved_state = state_snapshot.load_snapshot(STATE_SNAPSHOT_PATH)
+            if saved_state:
+                restore_state(saved_state)
+        start_background_tasks()
+
     # Use debug=False in production!
-    app.run(host='10.41.61.38', port=2242, debug=True)
+    app.run(host='10.41.61.38', port=2242, debug=DEBUG)
 
@@ -3,21 +3,52 @@
 
 import sqlite3
 import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_app_context
 from werkzeug.security import generate_password_hash
 
 # --- Configuration ---
 DATABASE = 'users.db'
 # Define allowed types, adding None implicitly by removing NOT NULL
 ALLOWED_USER_TYPES = ('guardian', 'protege')
+# Connection class for requests being profiled; set by request_profiler when profiling is enabled
+profiled_connection_factory = None
 
 # --- Database Functions ---
 
 def get_db():
     """Opens a new database connection."""
-    conn = sqlite3.connect(DATABASE)
+    if profiled_connection_factory is not None and has_app_context() and g.get('request_profiler') is not None:
+        conn = sqlite3.connect(DATABASE, factory=profiled_connection_factory)
+    else:
+        conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     return conn
 
+def create_users_table(cursor, if_not_exists=False):
+    """Creates the users table. user_type can be NULL."""
+    cursor.execute(f'''
+        CREATE TABLE {'IF NOT EXISTS ' if if_not_exists else ''}users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            user_type TEXT CHECK(user_type IS NULL OR user_type IN {ALLOWED_USER_TYPES}), -- Allow NULL
+            friend_email TEXT UNIQUE -- Link constraint remains
+        )
+    ''')
+
+def ensure_schema():
+    """Creates the schema if it is missing, leaving existing data untouched."""
+    db = get_db()
+    try:
+        with db:
+            create_users_table(db.cursor(), if_not_exists=True)
+    finally:
+        db.close()
+
 def init_db(populate=True):
     """Initializes the database schema and optionally populates it."""
     db = None
@@ -27,16 +58,7 @@ def init_db(populate=True):
         print("Initializing database schema...")
         cursor.execute('DROP TABLE IF EXISTS users')
         # Create users table: user_type can now be NULL
-        cursor.execute(f'''
-            CREATE TABLE users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                user_type TEXT CHECK(user_type IS NULL OR user_type IN {ALLOWED_USER_TYPES}), -- Allow NULL
-                friend_email TEXT UNIQUE -- Link constraint remains
-            )
-        ''')
+        create_users_table(cursor)
         print("Table 'users' created. 'user_type' can be NULL.")
 
         if populate:
@@ -123,10 +145,10 @@ def execute_db(query, args=()):
     db = None
     success = False
     try:
-        db = get_db()
-        # Use a context manager for connection to handle commit/rollback
-        with db:
-            db.execute(query, args)
+        with _write_db() as db:
+            # Use a context manager for connection to handle commit/rollback
+            with db:
+                db.execute(query, args)
         success = True
     except sqlite3.Error as e:
         print(f"Database execution error: {e}")
@@ -142,6 +164,181 @@ def execute_db(query, args=()):
     return success
 
 
+# --- In-Memory User Snapshot ---
+# The users table is small and read-mostly, so reads can be served from an
+# in-memory copy. The indexes are never modified in place: every change builds
+# new ones and publishes them in a single assignment, so lookups need no lock.
+# A dedicated connection watches PRAGMA data_version, which changes whenever
+# another connection commits: any such change triggers a full reload. Readers
+# check it at most every USER_SNAPSHOT_CHECK_INTERVAL seconds, and skip the
+# check while a write holds the lock. Writes made through this module run on
+# that same connection, which leaves its data_version unchanged, so they refresh
+# only the rows they touched and are visible as soon as they return.
+
+USER_SNAPSHOT_CHECK_INTERVAL = 0.5 # Seconds; how long other processes' commits may go unnoticed
+
+
+def _put(by_id, by_email, row):
+    user = dict(row)
+    by_id[user['id']] = user
+    by_email[user['email']] = user
+
+def _drop(by_id, by_email, user):
+    if user is not None:
+        by_id.pop(user['id'], None)
+        by_email.pop(user['email'], None)
+
+
+class UserSnapshot:
+    """Read-through snapshot of the users table with id, email and available-guardian indexes."""
+
+    def __init__(self, check_interval=USER_SNAPSHOT_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.RLock() # Serializes loads, refreshes and writes; readers don't take it
+        self._conn = None
+        self._data_version = None
+        self._next_check = 0.0
+        self._index = None # (by_id, by_email, available_guardians), replaced as a whole
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(DATABASE, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+        return self._conn
+
+    def _current_version(self):
+        self._next_check = time.monotonic() + self.check_interval
+        return self._connection().execute('PRAGMA data_version').fetchone()[0]
+
+    def _publish(self, by_id, by_email):
+        guardians = [u for u in by_id.values() if u['user_type'] == 'guardian' and u['friend_email'] is None]
+        guardians.sort(key=lambda u: (u['name'], u['email']))
+        self._index = (by_id, by_email, [{"name": u['name'], "email": u['email']} for u in guardians])
+
+    def _load_all(self):
+        # Read the version first so a commit racing with the load is seen on the next sync
+        version = self._current_version()
+        rows = self._connection().execute('SELECT * FROM users').fetchall()
+        by_id, by_email = {}, {}
+        for row in rows:
+            _put(by_id, by_email, row)
+        self._publish(by_id, by_email)
+        self._data_version = version
+        print(f"User snapshot loaded ({len(rows)} users).")
+
+    def _sync(self):
+        """Reloads everything if another connection has committed since the last load. Lock must be held."""
+        if self._current_version() != self._data_version:
+            self._load_all()
+
+    def _current_index(self):
+        """Returns the published indexes, checking for outside commits if the last check is old enough."""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._load_all()
+        elif time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                if time.monotonic() >= self._next_check: # Another reader may have just checked
+                    self._sync()
+            finally:
+                self._lock.release()
+        return self._index
+
+    @contextmanager
+    def write_connection(self):
+        """Yields the snapshot's own connection, locked, for a write made through this module."""
+        with self._lock:
+            yield self._connection()
+
+    def refresh(self, user_ids=(), emails=()):
+        """Reloads just the given users after a write made through write_connection()."""
+        with self._lock:
+            if self._index is None:
+                return # Never loaded; the first read does a full load anyway
+            if self._current_version() != self._data_version:
+                # Another connection committed as well, so more than these rows may have changed
+                self._load_all()
+                return
+            conn = self._connection()
+            by_id, by_email = dict(self._index[0]), dict(self._index[1])
+            for user_id in user_ids:
+                _drop(by_id, by_email, by_id.get(user_id))
+                row = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+                if row:
+                    _put(by_id, by_email, row)
+            for email in emails:
+                _drop(by_id, by_email, by_email.get(email))
+                row = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+                if row:
+                    _drop(by_id, by_email, by_id.get(row['id'])) # Row may be indexed under an old email
+                    _put(by_id, by_email, row)
+            self._publish(by_id, by_email)
+
+    def get_by_id(self, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        user = self._current_index()[0].get(user_id)
+        return dict(user) if user else None
+
+    def get_by_email(self, email):
+        user = self._current_index()[1].get(email)
+        return dict(user) if user else None
+
+    def get_available_guardians(self):
+        return [dict(g) for g in self._current_index()[2]]
+
+
+_user_snapshot = None
+
+def enable_user_snapshot():
+    """Serves user lookups from an in-memory snapshot instead of querying SQLite each time."""
+    global _user_snapshot
+    if _user_snapshot is None:
+        _user_snapshot = UserSnapshot()
+
+@contextmanager
+def _write_db():
+    """Connection for writes: the snapshot's own one when enabled, otherwise a new one."""
+    if _user_snapshot is not None:
+        with _user_snapshot.write_connection() as db:
+            yield db
+        return
+    db = get_db()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def _refresh_snapshot(user_ids=(), emails=()):
+    if _user_snapshot is not None:
+        try:
+            _user_snapshot.refresh(user_ids=user_ids, emails=emails)
+        except sqlite3.Error as e:
+            # The data_version check still picks the write up on the next read
+            print(f"User snapshot refresh error: {e}")
+
+def get_user_by_id(user_id):
+    """Returns the user row with the given id as a dictionary, or None."""
+    if _user_snapshot is not None:
+        try:
+            return _user_snapshot.get_by_id(user_id)
+        except sqlite3.Error as e:
+            print(f"User snapshot error, falling back to query: {e}")
+    return query_db('SELECT * FROM users WHERE id = ?', [user_id], one=True)
+
+def get_user_by_email(email):
+    """Returns the user row with the given email as a dictionary, or None."""
+    if _user_snapshot is not None:
+        try:
+            return _user_snapshot.get_by_email(email)
+        except sqlite3.Error as e:
+            print(f"User snapshot error, falling back to query: {e}")
+    return query_db('SELECT * FROM users WHERE email = ?', [email], one=True)
+
+
 def update_user_details(user_id, name=None, email=None, password=None):
     """Updates a user's name, email, or password hash."""
     fields_to_update = []
@@ -166,7 +363,10 @@ def update_user_details(user_id, name=None, email=None, password=None):
     params.append(user_id)
 
     try:
-        return execute_db(query, tuple(params))
+        success = execute_db(query, tuple(params))
+        if success:
+            _refresh_snapshot(user_ids=[user_id])
+        return success
     except sqlite3.IntegrityError as e:
          if "Email already exists" in str(e):
               print(f"Update failed: Email '{email}' already exists.")
@@ -178,16 +378,16 @@ def update_user_details(user_id, name=None, email=None, password=None):
 
 def link_users(protege_email, guardian_email):
     """Links a protege and a guardian by setting their friend_email fields."""
-    db = None
     try:
-        db = get_db()
-        # Use context manager for transaction
-        with db:
-            # Update protege's friend_email
-            db.execute("UPDATE users SET friend_email = ? WHERE email = ?", (guardian_email, protege_email))
-            # Update guardian's friend_email
-            db.execute("UPDATE users SET friend_email = ? WHERE email = ?", (protege_email, guardian_email))
+        with _write_db() as db:
+            # Use context manager for transaction
+            with db:
+                # Update protege's friend_email
+                db.execute("UPDATE users SET friend_email = ? WHERE email = ?", (guardian_email, protege_email))
+                # Update guardian's friend_email
+                db.execute("UPDATE users SET friend_email = ? WHERE email = ?", (protege_email, guardian_email))
         print(f"Successfully linked {protege_email} and {guardian_email}")
+        _refresh_snapshot(emails=[protege_email, guardian_email])
         return True
     except sqlite3.Error as e:
         print(f"Database error during linking: {e}")
@@ -199,24 +399,24 @@ def link_users(protege_email, guardian_email):
 
 def remove_link(user_email):
     """Removes the friend link for a user and their friend."""
-    db = None
     try:
-        db = get_db()
-        # Find the friend's email first
-        cursor_find = db.cursor()
-        cursor_find.execute("SELECT friend_email FROM users WHERE email = ?", (user_email,))
-        result = cursor_find.fetchone()
-        friend_email = result['friend_email'] if result else None
-
-        # Use context manager for transaction
-        with db:
-            # Remove link from the user
-            db.execute("UPDATE users SET friend_email = NULL WHERE email = ?", (user_email,))
-            # Remove link from the friend if they exist and are linked back
-            if friend_email:
-                db.execute("UPDATE users SET friend_email = NULL WHERE email = ? AND friend_email = ?", (friend_email, user_email))
+        with _write_db() as db:
+            # Find the friend's email first
+            cursor_find = db.cursor()
+            cursor_find.execute("SELECT friend_email FROM users WHERE email = ?", (user_email,))
+            result = cursor_find.fetchone()
+            friend_email = result['friend_email'] if result else None
+
+            # Use context manager for transaction
+            with db:
+                # Remove link from the user
+                db.execute("UPDATE users SET friend_email = NULL WHERE email = ?", (user_email,))
+                # Remove link from the friend if they exist and are linked back
+                if friend_email:
+                    db.execute("UPDATE users SET friend_email = NULL WHERE email = ? AND friend_email = ?", (friend_email, user_email))
 
         print(f"Successfully removed link for {user_email}" + (f" and {friend_email}" if friend_email else ""))
+        _refresh_snapshot(emails=[user_email] + ([friend_email] if friend_email else []))
         return True
     except sqlite3.Error as e:
         print(f"Database error during link removal: {e}")
@@ -229,41 +429,41 @@ def update_user_type(user_id, user_email, new_type):
     if new_type is not None and new_type not in ALLOWED_USER_TYPES:
         raise ValueError(f"Invalid user type '{new_type}'. Allowed types are {ALLOWED_USER_TYPES} or None.")
 
-    db = None
     try:
-        db = get_db()
-        # Use context manager for transaction
-        with db:
-            # Get current user details (type and friend) within the transaction
-            cursor_get = db.cursor()
-            cursor_get.execute("SELECT user_type, friend_email FROM users WHERE id = ?", (user_id,))
-            current_data = cursor_get.fetchone()
-            if not current_data:
-                raise ValueError("User not found.")
-
-            current_type = current_data['user_type']
-            current_friend = current_data['friend_email']
-
-            # If type is not changing, do nothing (commit will happen, but no changes made)
-            if current_type == new_type:
-                print(f"User {user_email} already has type '{new_type}'. No change needed.")
-                # No need to return early, let the transaction complete harmlessly
-            else:
-                print(f"Changing type for {user_email} from '{current_type}' to '{new_type}'")
-
-                # --- Unlinking Logic ---
-                if current_friend:
-                    print(f"User {user_email} is linked to {current_friend}. Unlinking before type change.")
-                    # Unlink the current user
-                    db.execute("UPDATE users SET friend_email = NULL WHERE id = ?", (user_id,))
-                    # Unlink the friend
-                    db.execute("UPDATE users SET friend_email = NULL WHERE email = ?", (current_friend,))
-                    print(f"Unlinked {user_email} and {current_friend}.")
-
-                # --- Update User Type ---
-                db.execute("UPDATE users SET user_type = ? WHERE id = ?", (new_type, user_id))
-                print(f"Updated type for user {user_id} ({user_email}) to '{new_type}'.")
-
+        with _write_db() as db:
+            # Use context manager for transaction
+            with db:
+                # Get current user details (type and friend) within the transaction
+                cursor_get = db.cursor()
+                cursor_get.execute("SELECT user_type, friend_email FROM users WHERE id = ?", (user_id,))
+                current_data = cursor_get.fetchone()
+                if not current_data:
+                    raise ValueError("User not found.")
+
+                current_type = current_data['user_type']
+                current_friend = current_data['friend_email']
+
+                # If type is not changing, do nothing (commit will happen, but no changes made)
+                if current_type == new_type:
+                    print(f"User {user_email} already has type '{new_type}'. No change needed.")
+                    # No need to return early, let the transaction complete harmlessly
+                else:
+                    print(f"Changing type for {user_email} from '{current_type}' to '{new_type}'")
+
+                    # --- Unlinking Logic ---
+                    if current_friend:
+                        print(f"User {user_email} is linked to {current_friend}. Unlinking before type change.")
+                        # Unlink the current user
+                        db.execute("UPDATE users SET friend_email = NULL WHERE id = ?", (user_id,))
+                        # Unlink the friend
+                        db.execute("UPDATE users SET friend_email = NULL WHERE email = ?", (current_friend,))
+                        print(f"Unlinked {user_email} and {current_friend}.")
+
+                    # --- Update User Type ---
+                    db.execute("UPDATE users SET user_type = ? WHERE id = ?", (new_type, user_id))
+                    print(f"Updated type for user {user_id} ({user_email}) to '{new_type}'.")
+
+        _refresh_snapshot(user_ids=[user_id], emails=[current_friend] if current_friend else [])
         return True # Transaction committed successfully
 
     except (sqlite3.Error, ValueError) as e:
@@ -276,6 +476,11 @@ def update_user_type(user_id, user_email, new_type):
 
 def get_available_guardians():
     """Fetches all users who are guardians and do not have a friend linked."""
+    if _user_snapshot is not None:
+        try:
+            return _user_snapshot.get_available_guardians()
+        except sqlite3.Error as e:
+            print(f"User snapshot error, falling back to query: {e}")
     query = """
         SELECT name, email
         FROM users
@@ -284,3 +489,19 @@ def get_available_guardians():
     """
     return query_db(query, args=(), one=False)
 
+
+def get_friend_emails(emails):
+    """Maps each given email to its linked friend's email, skipping unlinked or unknown users."""
+    emails = list(emails)
+    friends = {}
+    # Stay well below SQLite's limit on bound parameters per statement
+    for start in range(0, len(emails), 500):
+        chunk = emails[start:start + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        rows = query_db(
+            f"SELECT email, friend_email FROM users WHERE friend_email IS NOT NULL AND email IN ({placeholders})",
+            chunk
+        )
+        for row in rows or []:
+            friends[row['email']] = row['friend_email']
+    return friends
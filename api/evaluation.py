@@ -0,0 +1,182 @@
+# evaluation.py
+# Server-side threshold and anomaly checks over recent monitor samples.
+#
+# Every device (keyed by its owner's email) gets one row in a set of 2-D NumPy
+# arrays holding a fixed-size ring buffer of its latest samples. A tick
+# evaluates every sample recorded since the previous tick, for all devices, in
+# one vectorized pass, so the cost per tick is a handful of array operations no
+# matter how many thousands of devices report in.
+
+import threading
+import time
+import numpy as np
+
+# --- Configuration ---
+METRICS = ('temperature', 'humidity')
+
+# Per-metric limits:
+#   low / high : absolute bounds on each new sample
+#   rate       : max absolute change per minute, measured against the latest sample
+#                at least SensorWindows.min_rate_span seconds older, so fast
+#                reporting does not turn sensor noise into huge rates
+#   z          : max z-score of each new sample against the older samples in the device's window
+#   min_std    : floor for the window's standard deviation, so a flat baseline
+#                does not turn sensor-resolution noise into anomalies
+DEFAULT_THRESHOLDS = {
+    'temperature': {'low': 16.0, 'high': 30.0, 'rate': 2.0, 'z': 3.0, 'min_std': 0.2},
+    'humidity': {'low': 20.0, 'high': 70.0, 'rate': 10.0, 'z': 3.0, 'min_std': 1.0},
+}
+
+# Notification types emitted by evaluate(), in the order the checks run.
+CHECKS = ('high', 'low', 'rate', 'anomaly')
+NOTIFICATION_TYPES = tuple(f"{metric}_{check}" for metric in METRICS for check in CHECKS)
+
+
+def _as_float(value):
+    """Converts a sample value to float, mapping missing/invalid values to NaN."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class SensorWindows:
+    """Rolling windows of recent samples for every device, one array row per device."""
+
+    def __init__(self, window_size=30, min_samples=5, min_rate_span=10.0, initial_capacity=256):
+        self.window_size = window_size
+        self.min_samples = min_samples # Earlier samples needed as a baseline before z-scores are checked
+        self.min_rate_span = min_rate_span # Seconds; shortest interval a rate is measured over (keep well below the window's time span)
+        self._lock = threading.Lock()
+        self._rows = {} # device -> row index
+        self._devices = [] # row index -> device
+        self._values = np.full((len(METRICS), initial_capacity, window_size), np.nan)
+        self._timestamps = np.full((initial_capacity, window_size), np.nan)
+        self._counts = np.zeros(initial_capacity, dtype=np.int64) # Samples ever recorded per row
+        self._evaluated = np.zeros(initial_capacity, dtype=np.int64) # Value of _counts at the last evaluation
+
+    def _grow(self):
+        """Doubles the row capacity of every array, keeping existing rows."""
+        capacity = self._counts.shape[0] * 2
+        values = np.full((len(METRICS), capacity, self.window_size), np.nan)
+        timestamps = np.full((capacity, self.window_size), np.nan)
+        counts = np.zeros(capacity, dtype=np.int64)
+        evaluated = np.zeros(capacity, dtype=np.int64)
+        n = len(self._devices)
+        values[:, :n] = self._values[:, :n]
+        timestamps[:n] = self._timestamps[:n]
+        counts[:n] = self._counts[:n]
+        evaluated[:n] = self._evaluated[:n]
+        self._values, self._timestamps, self._counts, self._evaluated = values, timestamps, counts, evaluated
+
+    def record(self, device, sample, timestamp=None):
+        """Appends one sample (a dict with the METRICS keys) to the device's window."""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            row = self._rows.get(device)
+            if row is None:
+                row = len(self._devices)
+                if row == self._counts.shape[0]:
+                    self._grow()
+                self._rows[device] = row
+                self._devices.append(device)
+
+            slot = self._counts[row] % self.window_size
+            for i, metric in enumerate(METRICS):
+                self._values[i, row, slot] = _as_float(sample.get(metric))
+            self._timestamps[row, slot] = timestamp
+            self._counts[row] += 1
+
+    def export_state(self):
+        """Returns a picklable copy of all windows, for snapshots."""
+        with self._lock:
+            n = len(self._devices)
+            return {
+                "window_size": self.window_size,
+                "devices": list(self._devices),
+                "values": self._values[:, :n].copy(),
+                "timestamps": self._timestamps[:n].copy(),
+                "counts": self._counts[:n].copy(),
+            }
+
+    def restore_state(self, state):
+        """Replaces all windows with a previously exported state. Restored samples are not re-evaluated."""
+        if state["window_size"] != self.window_size:
+            raise ValueError(f"Window size mismatch: snapshot has {state['window_size']}, expected {self.window_size}.")
+        devices = state["devices"]
+        n = len(devices)
+        capacity = max(n, self._counts.shape[0])
+        with self._lock:
+            self._values = np.full((len(METRICS), capacity, self.window_size), np.nan)
+            self._timestamps = np.full((capacity, self.window_size), np.nan)
+            self._counts = np.zeros(capacity, dtype=np.int64)
+            self._evaluated = np.zeros(capacity, dtype=np.int64)
+            self._values[:, :n] = state["values"]
+            self._timestamps[:n] = state["timestamps"]
+            self._counts[:n] = state["counts"]
+            self._evaluated[:n] = state["counts"]
+            self._devices = list(devices)
+            self._rows = {device: row for row, device in enumerate(self._devices)}
+
+    def evaluate(self, thresholds=DEFAULT_THRESHOLDS):
+        """
+        Runs every check on all samples recorded since the last call.
+        Returns a list of (device, notification_type) tuples, one per device and type.
+        """
+        w = self.window_size
+        with self._lock:
+            n = len(self._devices)
+            rows = np.flatnonzero(self._counts[:n] > self._evaluated[:n])
+            if rows.size == 0:
+                return []
+            # Fancy indexing copies, so the math below runs without the lock held
+            values = self._values[:, rows]
+            timestamps = self._timestamps[rows]
+            counts = self._counts[rows]
+            # More than a window of samples per tick: the overwritten ones are lost
+            new_counts = np.minimum(counts - self._evaluated[rows], w)
+            devices = [self._devices[row] for row in rows]
+            self._evaluated[rows] = counts
+
+        # Put every window in recording order: position j holds sample number counts - w + j
+        k = np.arange(rows.size)[:, None]
+        order = (counts[:, None] - w + np.arange(w)) % w
+        timestamps = timestamps[k, order]
+        positions = np.arange(w)
+        is_new = positions >= (w - new_counts)[:, None]
+
+        alerts = []
+        # NaNs (missing samples, empty slots, zero std) simply compare as False
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Rate reference of each sample: the latest earlier one at least min_rate_span seconds older
+            older = ((positions[None, :] < positions[:, None])
+                     & (timestamps[:, None, :] <= timestamps[:, :, None] - self.min_rate_span))
+            ref = np.where(older, positions, -1).max(axis=2)
+            has_ref = ref >= 0
+            ref = np.maximum(ref, 0)
+            dt_minutes = np.where(has_ref, (timestamps - np.take_along_axis(timestamps, ref, axis=1)) / 60.0, np.nan)
+
+            for i, metric in enumerate(METRICS):
+                limits = thresholds[metric]
+                window = values[i][k, order]
+
+                # New samples are tested against the older ones, so they are left out of the baseline
+                baseline = ~is_new & ~np.isnan(window)
+                n_baseline = baseline.sum(axis=1)
+                mean = np.where(baseline, window, 0.0).sum(axis=1) / n_baseline
+                variance = np.where(baseline, (window - mean[:, None]) ** 2, 0.0).sum(axis=1) / n_baseline
+                std = np.maximum(np.sqrt(variance), limits.get('min_std', 0.0))
+                change = np.abs(window - np.take_along_axis(window, ref, axis=1))
+
+                flags = {
+                    'high': window > limits['high'],
+                    'low': window < limits['low'],
+                    'rate': change / dt_minutes > limits['rate'],
+                    'anomaly': (n_baseline >= self.min_samples)[:, None] & (np.abs(window - mean[:, None]) / std[:, None] > limits['z']),
+                }
+                for check in CHECKS:
+                    for j in np.flatnonzero((flags[check] & is_new).any(axis=1)):
+                        alerts.append((devices[j], f"{metric}_{check}"))
+
+        return alerts
@@ -0,0 +1,260 @@
+# import_users.py
+# Bulk, non-destructive import of users and guardian links from CSV or JSONL.
+#
+# Usage:
+#   python import_users.py residents.csv [--batch-size 1000] [--workers 4] [--report conflicts.csv]
+#
+# Each record has: name, email, password, user_type (guardian/protege/empty)
+# and an optional friend_email to link the user with. Records are streamed in
+# batches: passwords are hashed in parallel worker processes and each batch is
+# inserted with executemany in its own transaction. Links of the users that were
+# inserted are applied after all users are in. Existing users are never
+# overwritten or unlinked, but an existing unlinked user named as a new record's
+# friend_email is linked to it. Anything that cannot be imported is collected
+# and reported at the end.
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash
+
+import database
+
+# --- Configuration ---
+DEFAULT_BATCH_SIZE = 1000
+MAX_PARAMS_PER_QUERY = 500 # Stay well below SQLite's bound-parameter limit
+TEXT_FIELDS = ('name', 'email', 'password', 'user_type', 'friend_email')
+
+
+def read_records(path, file_format=None):
+    """Yields (line_number, record_dict) from a CSV or JSONL file without loading it whole."""
+    file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, newline='', encoding='utf-8') as f:
+        if file_format == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except json.JSONDecodeError:
+                        yield line_number, None
+
+
+def batched(iterable, size):
+    """Groups an iterable into lists of at most `size` items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _clean(value):
+    """Strips strings and maps empty values to None."""
+    if isinstance(value, str):
+        value = value.strip()
+    return value or None
+
+
+def select_by_emails(db, emails, columns='email'):
+    """Yields the user rows matching `emails`, querying in parameter-limited chunks."""
+    emails = list(emails)
+    for start in range(0, len(emails), MAX_PARAMS_PER_QUERY):
+        chunk = emails[start:start + MAX_PARAMS_PER_QUERY]
+        placeholders = ', '.join('?' * len(chunk))
+        yield from db.execute(f"SELECT {columns} FROM users WHERE email IN ({placeholders})", chunk)
+
+
+class UserImporter:
+    """Streams user records into the database and collects conflicts for a bulk report."""
+
+    def __init__(self, db, executor, workers, batch_size=DEFAULT_BATCH_SIZE):
+        self.db = db
+        self.executor = executor
+        self.workers = workers
+        self.batch_size = batch_size
+        self.seen_emails = set()
+        self.pending_links = [] # (line_number, email, friend_email)
+        self.conflicts = [] # (line_number, email, reason)
+        self.added = 0
+        self.linked = 0
+
+    def conflict(self, line_number, email, reason):
+        self.conflicts.append((line_number, email, reason))
+
+    def validate(self, line_number, record):
+        """Returns a normalized (line_number, name, email, password, user_type, friend_email) tuple, or None after recording a conflict."""
+        if not isinstance(record, dict):
+            self.conflict(line_number, None, "malformed record")
+            return None
+        # JSONL values can be numbers, lists, ...; only text is accepted
+        for field in TEXT_FIELDS:
+            if not isinstance(record.get(field), (str, type(None))):
+                email = record.get('email')
+                self.conflict(line_number, email if isinstance(email, str) else None, f"'{field}' must be text")
+                return None
+        name = _clean(record.get('name'))
+        email = _clean(record.get('email'))
+        password = record.get('password')
+        user_type = _clean(record.get('user_type'))
+        if not name or not email or not password:
+            self.conflict(line_number, email, "missing name, email or password")
+            return None
+        if '@' not in email:
+            self.conflict(line_number, email, "invalid email")
+            return None
+        if user_type is not None and user_type not in database.ALLOWED_USER_TYPES:
+            self.conflict(line_number, email, f"invalid user_type '{user_type}'")
+            return None
+        if email in self.seen_emails:
+            self.conflict(line_number, email, "duplicate email in input")
+            return None
+        self.seen_emails.add(email)
+
+        return line_number, name, email, password, user_type, _clean(record.get('friend_email'))
+
+    def new_users(self, users):
+        """Returns the users whose email is not in the database yet, recording the others as conflicts."""
+        already_there = {row['email'] for row in select_by_emails(self.db, (u[2] for u in users))}
+        new_users = []
+        for user in users:
+            if user[2] in already_there:
+                self.conflict(user[0], user[2], "email already exists")
+            else:
+                new_users.append(user)
+        return new_users
+
+    def import_batch(self, batch):
+        """Validates, hashes and inserts one batch of (line_number, record) pairs."""
+        users = [user for user in (self.validate(n, r) for n, r in batch) if user]
+        if not users:
+            return
+
+        # Filter before hashing so existing users don't cost a hash
+        users = self.new_users(users)
+
+        # Hashing dominates the cost of an import; spread it across processes
+        chunksize = max(1, len(users) // (4 * self.workers))
+        hashes = dict(zip((u[2] for u in users),
+                          self.executor.map(generate_password_hash, (u[3] for u in users), chunksize=chunksize)))
+
+        with self.db:
+            # Take the write lock before re-checking, so users added meanwhile by
+            # someone else are reported as conflicts instead of failing the insert
+            self.db.execute("BEGIN IMMEDIATE")
+            users = self.new_users(users)
+            self.db.executemany(
+                "INSERT INTO users (name, email, password_hash, user_type, friend_email) VALUES (?, ?, ?, ?, NULL)",
+                [(name, email, hashes[email], user_type) for _, name, email, _, user_type, _ in users]
+            )
+        self.added += len(users)
+        self.pending_links.extend((line_number, email, friend_email)
+                                  for line_number, _, email, _, _, friend_email in users if friend_email)
+        print(f"Imported {self.added} users so far...")
+
+    def apply_links(self):
+        """Links the collected guardian/protege pairs, skipping any that would overwrite an existing link."""
+        pairs = {}
+        for line_number, email, friend_email in self.pending_links:
+            pairs.setdefault(frozenset((email, friend_email)), (line_number, email, friend_email))
+
+        for batch in batched(pairs.values(), self.batch_size):
+            with self.db:
+                # Hold the write lock from the check to the updates so no link can change in between
+                self.db.execute("BEGIN IMMEDIATE")
+                emails = {e for _, email, friend_email in batch for e in (email, friend_email)}
+                users = {row['email']: row for row in select_by_emails(self.db, emails, 'email, user_type, friend_email')}
+
+                linked_now = set()
+                for line_number, email, friend_email in batch:
+                    user, friend = users.get(email), users.get(friend_email)
+                    if email == friend_email:
+                        self.conflict(line_number, email, "cannot link to self")
+                    elif user is None or friend is None:
+                        self.conflict(line_number, email, f"link target '{friend_email}' not found")
+                    elif {user['user_type'], friend['user_type']} != {'guardian', 'protege'}:
+                        self.conflict(line_number, email, f"link with '{friend_email}' must pair a guardian and a protege")
+                    elif user['friend_email'] or friend['friend_email'] or linked_now & {email, friend_email}:
+                        self.conflict(line_number, email, f"link with '{friend_email}' conflicts with an existing link")
+                    elif self.link_pair(email, friend_email):
+                        linked_now.update((email, friend_email))
+                        self.linked += 1
+                    else:
+                        self.conflict(line_number, email, f"link with '{friend_email}' conflicts with an existing link")
+
+    def link_pair(self, email, friend_email):
+        """Links both users or neither. Must run inside a transaction; returns whether the link was made."""
+        self.db.execute("SAVEPOINT link_pair")
+        try:
+            updated = sum(
+                self.db.execute("UPDATE users SET friend_email = ? WHERE email = ? AND friend_email IS NULL", params).rowcount
+                for params in ((friend_email, email), (email, friend_email))
+            )
+        except sqlite3.IntegrityError: # Someone else already points at one of them
+            updated = 0
+        if updated != 2:
+            self.db.execute("ROLLBACK TO link_pair")
+        self.db.execute("RELEASE link_pair")
+        return updated == 2
+
+    def report(self, report_path=None, examples=10):
+        """Prints a summary of the import and the conflicts grouped by reason."""
+        print(f"Import finished: {self.added} users added, {self.linked} links created, {len(self.conflicts)} conflicts.")
+        if not self.conflicts:
+            return
+        for reason, count in Counter(reason for _, _, reason in self.conflicts).most_common():
+            print(f"  {count:>6}  {reason}")
+        for line_number, email, reason in self.conflicts[:examples]:
+            print(f"  line {line_number}: {email or '-'}: {reason}")
+        if report_path:
+            with open(report_path, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['line', 'email', 'reason'])
+                writer.writerows(self.conflicts)
+            print(f"Full conflict report written to '{report_path}'.")
+        elif len(self.conflicts) > examples:
+            print(f"  ... {len(self.conflicts) - examples} more (use --report to save them all)")
+
+
+def import_users(path, file_format=None, batch_size=DEFAULT_BATCH_SIZE, workers=None, report_path=None):
+    """Imports users and links from `path` into the configured database."""
+    workers = workers or os.cpu_count() or 1
+    database.ensure_schema()
+    db = database.get_db()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            importer = UserImporter(db, executor, workers, batch_size=batch_size)
+            for batch in batched(read_records(path, file_format), batch_size):
+                importer.import_batch(batch)
+        importer.apply_links()
+        importer.report(report_path)
+        return importer
+    except sqlite3.Error as e:
+        print(f"Database error during import: {e}")
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk import users and guardian links from CSV or JSONL.")
+    parser.add_argument('path', help="CSV (with header) or JSONL file of user records")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help="Input format (default: from file extension)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="Records per transaction")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Password hashing processes")
+    parser.add_argument('--report', help="Write every conflict to this CSV file")
+    parser.add_argument('--database', default=database.DATABASE, help="SQLite database file")
+    args = parser.parse_args()
+
+    database.DATABASE = args.database
+    import_users(args.path, args.format, args.batch_size, args.workers, args.report)
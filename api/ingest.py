@@ -0,0 +1,95 @@
+# ingest.py
+# Decoders for the compact binary payloads sent by sensor and wearable clients.
+#
+# JSON stays the default for every endpoint. A client opts into the binary
+# layout by sending the matching Content-Type; the body is then decoded with
+# struct unpacking straight from a memoryview of the request bytes, without
+# building any intermediate text or dict of untrusted keys.
+#
+# All multi-byte fields are little-endian (the native order of the ARM boards
+# running NuttX and of Android/Wear OS devices).
+
+import math
+import struct
+
+# --- Content Types ---
+MONITOR_CONTENT_TYPE = 'application/vnd.halotrack.monitor'
+NOTIFICATION_CONTENT_TYPE = 'application/vnd.halotrack.notify'
+
+PAYLOAD_VERSION = 1
+
+# --- Layouts ---
+# Monitor sample (9 bytes), optionally followed by the owner's email:
+#   uint8   version
+#   float32 temperature (degrees Celsius)
+#   float32 humidity (%rH)
+#   bytes   protege email, UTF-8, rest of the body (may be empty)
+MONITOR_STRUCT = struct.Struct('<Bff')
+
+# Notification header (4 bytes), followed by the two UTF-8 encoded emails:
+#   uint8   version
+#   uint8   notification type code (index into the allowed types tuple)
+#   uint8   recipient email length in bytes
+#   uint8   sender email length in bytes
+#   bytes   recipient email
+#   bytes   sender email
+NOTIFICATION_HEADER_STRUCT = struct.Struct('<BBBB')
+
+
+def decode_monitor_payload(body):
+    """
+    Decodes a binary monitor sample into {"temperature": ..., "humidity": ...},
+    adding "protege_email" when the owner's email trails the fixed fields.
+    """
+    buf = memoryview(body)
+    if len(buf) < MONITOR_STRUCT.size:
+        raise ValueError(f"Monitor payload must be at least {MONITOR_STRUCT.size} bytes, got {len(buf)}.")
+
+    version, temperature, humidity = MONITOR_STRUCT.unpack_from(buf)
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported monitor payload version {version}.")
+    if not (math.isfinite(temperature) and math.isfinite(humidity)):
+        raise ValueError("Temperature and humidity must be finite numbers.")
+
+    # float32 carries ~7 significant digits; round so the stored values match
+    # what the JSON clients send (two decimals).
+    data = {"temperature": round(temperature, 2), "humidity": round(humidity, 2)}
+    if len(buf) > MONITOR_STRUCT.size:
+        try:
+            data["protege_email"] = str(buf[MONITOR_STRUCT.size:], 'utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("Email in monitor payload must be valid UTF-8.")
+    return data
+
+
+def decode_notification_payload(body, notification_types):
+    """
+    Decodes a binary notification into the same dict shape the JSON endpoint reads:
+    {"recipient_email": ..., "sender_email": ..., "notification_type": ...}.
+    `notification_types` is the ordered tuple the type code indexes into.
+    """
+    buf = memoryview(body)
+    header_size = NOTIFICATION_HEADER_STRUCT.size
+    if len(buf) < header_size:
+        raise ValueError(f"Notification payload too short ({len(buf)} bytes).")
+
+    version, type_code, recipient_len, sender_len = NOTIFICATION_HEADER_STRUCT.unpack_from(buf)
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Unsupported notification payload version {version}.")
+    if type_code >= len(notification_types):
+        raise ValueError(f"Unknown notification type code {type_code}.")
+    if len(buf) != header_size + recipient_len + sender_len:
+        raise ValueError("Notification payload length does not match the encoded email lengths.")
+
+    recipient_end = header_size + recipient_len
+    try:
+        recipient_email = str(buf[header_size:recipient_end], 'utf-8')
+        sender_email = str(buf[recipient_end:], 'utf-8')
+    except UnicodeDecodeError:
+        raise ValueError("Emails in notification payload must be valid UTF-8.")
+
+    return {
+        "recipient_email": recipient_email,
+        "sender_email": sender_email,
+        "notification_type": notification_types[type_code],
+    }
@@ -0,0 +1,116 @@
+# json_provider.py
+# Faster response serialization for the Flask app.
+#
+# - Responses are encoded with orjson when it is installed (pip install orjson)
+#   and with the stdlib json module otherwise. Keys are sorted and datetimes use
+#   the HTTP date format, as with Flask's default provider. Differences with
+#   orjson: non-ASCII characters are emitted as UTF-8 instead of \u escapes,
+#   and NaN/Infinity are written as null instead of the non-standard tokens.
+# - Request bodies are still parsed by the stdlib json module, so accepted
+#   input is exactly what Flask's default provider accepts.
+# - Clients that send "Accept: application/msgpack" get MessagePack instead of
+#   JSON when msgpack is installed (pip install msgpack).
+# - Responses larger than a threshold are gzip-compressed for clients that
+#   accept it; small hot responses are left alone, where compression costs more
+#   than it saves.
+
+import gzip
+from flask import request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError: # Optional dependency
+    orjson = None
+
+try:
+    import msgpack
+except ImportError: # Optional dependency
+    msgpack = None
+
+# --- Configuration ---
+MSGPACK_MIMETYPE = 'application/msgpack'
+DEFAULT_GZIP_MIN_SIZE = 1024 # Bytes
+GZIP_LEVEL = 1 # On API payloads, level 1 is about as small as level 6 at half the CPU (see "gzip level" in bench_json.py)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider encoding with orjson when available, with opt-in MessagePack responses."""
+
+    if orjson is not None:
+        # Datetimes are passed to self.default so they keep Flask's HTTP date format
+        _orjson_options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def _encode(self, obj, indent=False):
+        """Serializes obj to JSON text, preferring orjson."""
+        if orjson is not None:
+            options = self._orjson_options | (orjson.OPT_INDENT_2 if indent else 0)
+            try:
+                return orjson.dumps(obj, default=self.default, option=options).decode('utf-8')
+            except orjson.JSONEncodeError:
+                pass # e.g. non-string dict keys or huge ints; let the stdlib handle it
+        if indent:
+            return super().dumps(obj, indent=2)
+        return super().dumps(obj, separators=(",", ":"))
+
+    def dumps(self, obj, **kwargs):
+        if kwargs: # Caller asked for specific json.dumps options
+            return super().dumps(obj, **kwargs)
+        return self._encode(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+
+        # Substring check first so the common JSON request skips Accept header parsing
+        if msgpack is not None and has_request_context() and 'msgpack' in request.headers.get('Accept', ''):
+            best = request.accept_mimetypes.best_match((self.mimetype, MSGPACK_MIMETYPE))
+            if best == MSGPACK_MIMETYPE:
+                response = self._app.response_class(
+                    msgpack.packb(obj, default=self.default, use_bin_type=True), mimetype=MSGPACK_MIMETYPE
+                )
+                add_vary(response, 'Accept')
+                return response
+
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        response = self._app.response_class(f"{self._encode(obj, indent)}\n", mimetype=self.mimetype)
+        if msgpack is not None:
+            add_vary(response, 'Accept')
+        return response
+
+
+def add_vary(response, header):
+    """Appends to the Vary header. Cheaper than response.vary, which parses it into a HeaderSet."""
+    vary = response.headers.get('Vary')
+    response.headers['Vary'] = f"{vary}, {header}" if vary else header
+
+
+def gzip_response(response, min_size):
+    """Compresses a response body in place if it is large enough and the client accepts gzip."""
+    if (response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or not 200 <= response.status_code < 300):
+        return response
+    # Below the threshold the body never depends on Accept-Encoding, so no Vary is needed
+    length = response.calculate_content_length()
+    if length is not None and length < min_size:
+        return response
+    add_vary(response, 'Accept-Encoding')
+    if request.accept_encodings['gzip'] <= 0:
+        return response
+
+    data = response.get_data()
+    response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def init_app(app, gzip_min_size=DEFAULT_GZIP_MIN_SIZE):
+    """Installs the fast JSON provider and, if gzip_min_size is set, response compression."""
+    app.json = FastJSONProvider(app)
+    if gzip_min_size:
+        @app.after_request
+        def compress_response(response):
+            return gzip_response(response, gzip_min_size)
+    print(f"JSON provider: {'orjson' if orjson else 'stdlib json'}, "
+          f"MessagePack {'enabled' if msgpack else 'unavailable'}, "
+          f"gzip {'from ' + str(gzip_min_size) + ' bytes' if gzip_min_size else 'disabled'}.")
@@ -0,0 +1,211 @@
+# request_profiler.py
+# Opt-in per-request profiler writing flamegraph-compatible folded stacks.
+#
+# A request is profiled when PROFILE_ALL_REQUESTS is set, or when it carries an
+# X-Profile-Token header matching the configured admin token. Profiled requests
+# are rate-limited. Each profile is a ".folded" file (one "frame;frame;frame
+# microseconds" line per stack), ready for flamegraph.pl or speedscope. SQL
+# statements show up as "SQL <statement>" frames under the code that ran them.
+#
+# If neither option is configured, init_app() installs nothing, so there is no
+# per-request or per-query overhead at all.
+
+import hmac
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+from flask import request, g
+
+import database
+
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+MAX_SQL_LABEL_LENGTH = 100
+
+
+class StackProfiler:
+    """Deterministic profiler accumulating self time per call stack for the current thread."""
+
+    def __init__(self, root):
+        self.root = root
+        self.stack = [] # [path, start, child_time, is_sql]
+        self.self_times = defaultdict(float) # folded path -> seconds
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self._labels = {} # code object -> frame label
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _push(self, label, now, is_sql=False):
+        parent = self.stack[-1][0] if self.stack else self.root
+        self.stack.append([f"{parent};{label.replace(';', ',')}", now, 0.0, is_sql])
+
+    def _pop(self, now):
+        path, start, child_time, is_sql = self.stack.pop()
+        elapsed = now - start
+        self.self_times[path] += elapsed - child_time
+        if self.stack:
+            self.stack[-1][2] += elapsed
+        if is_sql:
+            self.sql_time += elapsed
+
+    def _callback(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == 'call':
+            code = frame.f_code
+            if code in _SQL_CODES:
+                label = _SQL_CODES[code]
+                if label is None: # A statement: name the frame after it
+                    label = _sql_label(frame)
+                    self.sql_count += 1
+                self._push(label, now, is_sql=True)
+            else:
+                self._push(self._label(code), now)
+        elif event == 'c_call':
+            if isinstance(getattr(arg, '__self__', None), _SQLITE_TYPES) and not (self.stack and self.stack[-1][3]):
+                # SQL on a plain connection, e.g. the user snapshot's: timed, but not labelled with the statement
+                if arg.__name__ in ('execute', 'executemany'):
+                    self.sql_count += 1
+                self._push(f"SQL {arg.__qualname__}", now, is_sql=True)
+            else:
+                self._push(f"<built-in> {getattr(arg, '__qualname__', None) or repr(arg)}", now)
+        elif self.stack: # return / c_return / c_exception; ignore frames entered before start()
+            self._pop(now)
+
+    def start(self):
+        sys.setprofile(self._callback) # Only affects the current thread
+
+    def stop(self):
+        sys.setprofile(None)
+        now = time.perf_counter()
+        while self.stack: # Frames still open when profiling stopped
+            self._pop(now)
+
+    def write_folded(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, seconds in self.self_times.items():
+                microseconds = int(seconds * 1e6)
+                if microseconds > 0:
+                    f.write(f"{stack} {microseconds}\n")
+
+
+def _sql_label(frame):
+    """Names a SQL frame after its statement, collapsed to one short line."""
+    sql = re.sub(r'\s+', ' ', str(frame.f_locals.get('sql'))).strip()
+    if len(sql) > MAX_SQL_LABEL_LENGTH:
+        sql = sql[:MAX_SQL_LABEL_LENGTH - 3] + '...'
+    return f"SQL {sql}"
+
+
+# --- Profiled SQLite connections ---
+# database.get_db() opens these only during a profiled request, so other
+# requests keep plain connections. The overridden methods are pass-throughs;
+# the profiler recognises their code objects and labels them with the SQL being
+# run. Queries on other connections, such as the user snapshot's long-lived
+# one, are still timed as SQL but named after the sqlite3 method instead.
+
+class ProfiledCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return super().executemany(sql, seq_of_parameters)
+
+    def fetchone(self):
+        return super().fetchone()
+
+    def fetchmany(self, size=None):
+        return super().fetchmany(size) if size is not None else super().fetchmany()
+
+    def fetchall(self):
+        return super().fetchall()
+
+
+class ProfiledConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute creates a plain Cursor internally, so route through ours
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        return super().commit()
+
+    def __exit__(self, exc_type, exc_value, traceback): # Commits or rolls back `with db:` blocks
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+_SQLITE_TYPES = (sqlite3.Connection, sqlite3.Cursor)
+
+# Code object -> fixed frame label, or None to label the frame with its SQL statement
+_SQL_CODES = {
+    ProfiledCursor.execute.__code__: None,
+    ProfiledCursor.executemany.__code__: None,
+    ProfiledCursor.fetchone.__code__: "SQL fetch",
+    ProfiledCursor.fetchmany.__code__: "SQL fetch",
+    ProfiledCursor.fetchall.__code__: "SQL fetch",
+    ProfiledConnection.commit.__code__: "SQL COMMIT",
+    ProfiledConnection.__exit__.__code__: "SQL COMMIT",
+}
+
+
+# --- Flask integration ---
+
+def init_app(app, directory, admin_token=None, profile_all=False, min_interval=1.0):
+    """Registers the profiling hooks. Does nothing unless admin_token or profile_all is set."""
+    if not admin_token and not profile_all:
+        return
+
+    database.profiled_connection_factory = ProfiledConnection
+    rate_lock = threading.Lock()
+    last_profile = [float('-inf')]
+
+    def should_profile():
+        if not profile_all:
+            token = request.headers.get(PROFILE_TOKEN_HEADER)
+            if not token or not hmac.compare_digest(token.encode(), admin_token.encode()):
+                return False
+        with rate_lock:
+            now = time.monotonic()
+            if now - last_profile[0] < min_interval:
+                return False
+            last_profile[0] = now
+        return True
+
+    @app.before_request
+    def start_profiling():
+        if should_profile():
+            g.request_profiler = StackProfiler(root=f"{request.method} {request.path}")
+            g.request_profiler.start()
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        profiler = g.pop('request_profiler', None)
+        if profiler is None:
+            return
+        profiler.stop()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            endpoint = (request.endpoint or 'unknown').replace('.', '_')
+            path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{endpoint}.folded")
+            profiler.write_folded(path)
+            total = sum(profiler.self_times.values())
+            print(f"Profiled {profiler.root}: {total * 1000:.1f} ms, {profiler.sql_count} SQL calls "
+                  f"({profiler.sql_time * 1000:.1f} ms) -> {path}")
+        except OSError as e:
+            print(f"Could not write request profile: {e}")
+
+    print(f"Request profiling enabled ({'all requests' if profile_all else 'admin header'}, "
+          f"at most one every {min_interval}s) -> '{directory}'.")
@@ -0,0 +1,66 @@
+# state_snapshot.py
+# Saves and restores the server's in-memory state (notification queues, latest
+# monitor data, sensor windows) so a restart does not lose it.
+#
+# Snapshots are pickled (compact binary, handles NumPy arrays natively) and
+# written atomically: the bytes go to a temporary file in the same directory,
+# which is fsynced and then renamed over the previous snapshot. A crash mid-write
+# therefore always leaves the last complete snapshot in place.
+#
+# Only load snapshots written by this server: unpickling runs arbitrary code.
+
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_last_payload = None # Skip rewriting identical snapshots
+_save_lock = threading.Lock() # The periodic ticker and the atexit hook may save at the same time
+
+
+def save_snapshot(path, state):
+    """Atomically writes `state` to `path`. Returns False if nothing changed since the last save."""
+    global _last_payload
+    with _save_lock:
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        if payload == _last_payload:
+            return False
+
+        data = pickle.dumps(
+            {"version": SNAPSHOT_FORMAT_VERSION, "saved_at": time.time(), "state": payload},
+            protocol=pickle.HIGHEST_PROTOCOL
+        )
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        _last_payload = payload
+        return True
+
+
+def load_snapshot(path):
+    """Returns the state saved at `path`, or None if there is no usable snapshot."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get("version") != SNAPSHOT_FORMAT_VERSION:
+            print(f"Ignoring snapshot '{path}' with unsupported version {data.get('version')}.")
+            return None
+        age = time.time() - data["saved_at"]
+        print(f"Loaded state snapshot '{path}' ({age:.0f}s old).")
+        return pickle.loads(data["state"])
+    except Exception as e:
+        print(f"Could not load state snapshot '{path}': {e}")
+        return None
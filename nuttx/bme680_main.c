@@ -47,6 +47,20 @@
 
 #define REQUEST_BUF_SIZE 512
 #define RESPONSE_BUF_SIZE 512
+
+/* Send the compact binary sample (see api/ingest.py) instead of JSON.
+ * Layout, little-endian: uint8 version, float32 temperature, float32 humidity.
+ * Requires a server with binary ingest support, so it is off by default.
+ */
+#define MONITOR_USE_BINARY_PAYLOAD 0
+#define MONITOR_CONTENT_TYPE "application/vnd.halotrack.monitor"
+#define MONITOR_PAYLOAD_VERSION 1
+#define MONITOR_PAYLOAD_SIZE 9
+
+/* Email of the protege this sensor belongs to. Sent with every sample so the
+ * server can evaluate it and alert the linked guardian; leave empty to skip.
+ */
+#define MONITOR_OWNER_EMAIL "johny@email.com"
 /* ----------------------- */
 
 #define NB_LOWERHALFS 3
@@ -163,7 +177,9 @@ static int send_monitoring_data(const char *server_ip, int port, float temperatu
 {
   int sockfd;
   char request_buf[REQUEST_BUF_SIZE];
-  char json_body[100];                  // Buffer for JSON payload
+  char body[192];                       // Buffer for JSON or binary payload
+  size_t owner_len = strlen(MONITOR_OWNER_EMAIL);
+  const char *content_type;
   char response_buf[RESPONSE_BUF_SIZE]; // For reading response
   int content_length;
   int bytes_sent;
@@ -178,22 +194,46 @@ static int send_monitoring_data(const char *server_ip, int port, float temperatu
     return -1; // Connection failed
   }
 
+#if MONITOR_USE_BINARY_PAYLOAD
+  // Create binary body: version byte, the raw floats, then the owner email.
+  // NuttX targets here are little-endian, matching the server's layout.
+  if (owner_len > sizeof(body) - MONITOR_PAYLOAD_SIZE)
+  {
+    fprintf(stderr, "ERROR: MONITOR_OWNER_EMAIL too long for payload buffer.\n");
+    close(sockfd);
+    return -1;
+  }
+  body[0] = MONITOR_PAYLOAD_VERSION;
+  memcpy(body + 1, &temperature, sizeof(float));
+  memcpy(body + 1 + sizeof(float), &humidity, sizeof(float));
+  memcpy(body + MONITOR_PAYLOAD_SIZE, MONITOR_OWNER_EMAIL, owner_len);
+  content_length = MONITOR_PAYLOAD_SIZE + owner_len;
+  content_type = MONITOR_CONTENT_TYPE;
+#else
   // Create JSON body
   // Ensure temperature/humidity are valid numbers before sending
-  snprintf(json_body, sizeof(json_body),
-           "{\"temperature\": %.2f, \"humidity\": %.2f}",
-           temperature, humidity);
-  content_length = strlen(json_body);
+  content_length = snprintf(body, sizeof(body),
+                            "{\"temperature\": %.2f, \"humidity\": %.2f, \"protege_email\": \"%s\"}",
+                            temperature, humidity, MONITOR_OWNER_EMAIL);
+  if (content_length < 0 || content_length >= (int)sizeof(body))
+  {
+    fprintf(stderr, "ERROR: JSON body too large for payload buffer.\n");
+    close(sockfd);
+    return -1;
+  }
+  content_type = "application/json";
+  (void)owner_len;
+#endif
 
   // Construct the HTTP PUT request headers
   header_len = snprintf(request_buf, REQUEST_BUF_SIZE,
                         "PUT /api/monitor/data HTTP/1.1\r\n"
                         "Host: %s:%d\r\n"
-                        "Content-Type: application/json\r\n"
+                        "Content-Type: %s\r\n"
                         "Content-Length: %d\r\n"
                         "Connection: close\r\n"
                         "\r\n",
-                        server_ip, port, content_length);
+                        server_ip, port, content_type, content_length);
 
   if (header_len < 0 || header_len >= REQUEST_BUF_SIZE)
   {
@@ -206,14 +246,14 @@ static int send_monitoring_data(const char *server_ip, int port, float temperatu
   total_len = header_len + content_length;
   if (total_len >= REQUEST_BUF_SIZE)
   {
-    fprintf(stderr, "ERROR: Request buffer too small for headers and JSON body (%d needed, %d available).\n",
+    fprintf(stderr, "ERROR: Request buffer too small for headers and body (%d needed, %d available).\n",
             total_len, REQUEST_BUF_SIZE);
     close(sockfd);
     return -1;
   }
 
-  // Append JSON body to the request buffer
-  memcpy(request_buf + header_len, json_body, content_length);
+  // Append body to the request buffer (binary body may contain NUL bytes)
+  memcpy(request_buf + header_len, body, content_length);
 
   // Send the complete request (headers + body)
   bytes_sent = send(sockfd, request_buf, total_len, 0);